@@ -4,119 +4,738 @@ import cv2
 import numpy as np
 import time
 import os
+import struct
 import argparse
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the decorated functions just run as plain Python.
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# Number of template lookups run on the same screenshot in parallel.
+LOOKUP_WORKERS = 3
+
+# Make sure OpenCV uses its SIMD kernels, and split the cores between the lookups that run at once
+# so that each match doesn't spread over all of them.
+cv2.setUseOptimized(True)
+cv2.setNumThreads(max(1, min(8, os.cpu_count() or 1) // LOOKUP_WORKERS))
+
+# Used to run several template lookups on the same screenshot in parallel.
+# OpenCV releases the GIL while matching.
+_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+
+# The most recent screenshot, decoded in memory.
+_last_screen = None
+
+
+def check_opencv_build():
+    """
+    Warns if OpenCV can't use AVX2 on an x86 CPU, which makes template matching a lot slower.
+    """
+    if platform.machine().lower() not in ("x86_64", "amd64"):
+        return
+
+    # Features prefixed with "*" are dispatched at runtime. A "?" suffix (e.g. "*AVX2?") means the feature is built in
+    # but not supported by this CPU, so only an exact "AVX2" counts.
+    features = cv2.getCPUFeaturesLine().split()
+    if not any(f.lstrip("*") == "AVX2" for f in features):
+        print(f"Warning: OpenCV is not using AVX2 (CPU features: {cv2.getCPUFeaturesLine()}).")
+        print("Template matching will be slow. Consider installing a recent opencv-python-headless.")
+
+
+def grab_screen():
+    """
+    Captures the device screen using ADB and returns it as a grayscale image.
+    Uses the raw framebuffer rather than PNG output to avoid encoding and decoding the image.
+    """
+    raw = subprocess.check_output(["adb", "exec-out", "screencap"])
+    # A device that is waking up may not return anything.
+    if len(raw) < 12:
+        raise ValueError(f"Screencap output too short ({len(raw)} bytes)")
+    w, h, fmt = struct.unpack("<III", raw[:12])
+    # Newer versions of Android add a color space field to the header, so compute its size.
+    offset = len(raw) - w * h * 4
+    if offset not in (12, 16):
+        raise ValueError(f"Unexpected screencap size {len(raw)} for {w}x{h} (format {fmt})")
+
+    arr = np.frombuffer(raw, dtype=np.uint8, offset=offset).reshape(h, w, 4)
+    return cv2.cvtColor(arr, cv2.COLOR_RGBA2GRAY)
 
-def take_screenshot(output_path="screen.png"):
+
+class ScreenPipeline:
     """
-    Captures the device screen using ADB and saves it to a file.
+    Grabs screenshots in a background thread. Callers that poll the screen can have the next screenshot started
+    as soon as one is handed out, so that it transfers while the current one is being searched.
+    Actions on the device call invalidate, which throws away screenshots started before them; the next
+    screenshot is then only started when it is asked for, so that waits after actions are respected.
     """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.requested = False
+        self.busy = False
+        # The next screenshot, or the exception raised while taking it.
+        self.frame = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def invalidate(self):
+        """
+        Marks the screenshots taken so far, or being taken, as out of date.
+        """
+        with self.cond:
+            self.generation += 1
+            self.requested = False
+            self.frame = None
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.requested:
+                    self.cond.wait()
+                self.requested = False
+                self.busy = True
+                generation = self.generation
+
+            try:
+                frame = grab_screen()
+            except Exception as e:
+                frame = e
+
+            with self.cond:
+                self.busy = False
+                if generation == self.generation:
+                    self.frame = frame
+                self.cond.notify_all()
+
+    def next_screen(self, prefetch=False):
+        """
+        Returns a screenshot started after the last action, raising whatever grab_screen raised.
+        If prefetch is set, the next screenshot is started right away. Only worth it when nothing is done on
+        the device before asking for it, since actions throw it away.
+        """
+        with self.cond:
+            while self.frame is None:
+                if not self.busy and not self.requested:
+                    self.requested = True
+                    self.cond.notify_all()
+                self.cond.wait()
+
+            frame, self.frame = self.frame, None
+            if prefetch:
+                self.requested = True
+                self.cond.notify_all()
+
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+
+_screen_pipeline = ScreenPipeline()
+
+
+def take_screenshot(prefetch=False):
+    """
+    Captures the device screen. prefetch starts on the next screenshot right away, see ScreenPipeline.next_screen.
+    Returns the screenshot as an image, or None if it could not be taken.
+    """
+    global _last_screen
     try:
-        # Execute adb command to capture screen and pipe it to a file
-        # This is often faster than 'adb shell screencap -p /sdcard/screen.png' + 'adb pull'
-        with open(output_path, "wb") as f:
-            subprocess.check_call(["adb", "exec-out", "screencap", "-p"], stdout=f)
-        print(f"Screenshot saved to {output_path}")
-        return True
-    except subprocess.CalledProcessError as e:
+        _last_screen = _screen_pipeline.next_screen(prefetch)
+        return _last_screen
+    except (subprocess.CalledProcessError, ValueError) as e:
         print(f"Error taking screenshot: {e}")
-        return False
+        return None
     except FileNotFoundError:
         print("ADB not found. Please ensure Android Debug Bridge is installed and in your PATH.")
-        return False
+        return None
 
 
-def find_element(template_path, screen_path="screen.png", threshold=0.8):
+def wait_until(condition, timeout=2.0, poll=0.1):
     """
-    Locates a UI element (template) within the screenshot.
-    Returns the (x, y) coordinates of the center of the match, or None if not found.
+    Takes screenshots until condition(screen) holds, rather than sleeping for a fixed time after an action.
+    Returns True if the condition held before the timeout.
     """
-    if not os.path.exists(template_path):
-        print(f"Template file not found: {template_path}")
-        return None
+    deadline = time.monotonic() + timeout
+    while True:
+        screen = take_screenshot()
+        if screen is not None and condition(screen):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll)
+
+
+# Templates are first matched against a screen downscaled by this factor to find candidate regions,
+# which are then matched again at full resolution.
+PYRAMID_SCALE = 2
+# How far below the threshold a match on the downscaled screen may be and still be refined.
+# Thin icons lose a lot of detail when downscaled, so this has to be generous.
+COARSE_MARGIN = 0.3
+# Downscaled templates with at least this many pixels are correlated in the frequency domain instead,
+# where reusing the template's spectrum beats cv2.matchTemplate.
+FFT_MIN_AREA = 5000
+# DFT heights are rounded up to a multiple of this, so that the bands of different heights searched by
+# IncrementalMatcher share a few template spectra.
+DFT_HEIGHT_STEP = 256
+# Number of pixels compared by quick_probe, and how far off their gray level may be.
+PROBE_POINTS = 16
+PROBE_TOLERANCE = 16
+
+
+def _downscale(screen):
+    return cv2.resize(screen, None, fx=1 / PYRAMID_SCALE, fy=1 / PYRAMID_SCALE, interpolation=cv2.INTER_AREA)
+
+
+def _spectrum(image, shape):
+    """
+    Zero-pads image to shape and returns its DFT, in packed CCS format.
+    """
+    padded = cv2.copyMakeBorder(image.astype(np.float32), 0, shape[0] - image.shape[0], 0, shape[1] - image.shape[1],
+                                cv2.BORDER_CONSTANT, value=0)
+    return cv2.dft(padded)
+
+
+def _probe_points(gray):
+    """
+    Picks pixels spread over flat areas of the template, whose gray level any match has to reproduce.
+    Returns a list of (dy, dx, value).
+    """
+    template = gray.astype(np.float32)
+    mean = cv2.blur(template, (5, 5))
+    variance = cv2.blur(template * template, (5, 5)) - mean * mean
+    # Stay away from the borders, where the blur is not meaningful.
+    variance[:2, :] = variance[-2:, :] = np.inf
+    variance[:, :2] = variance[:, -2:] = np.inf
+    ys, xs = np.nonzero(variance < 4)
+    if ys.size == 0:
+        return []
+
+    picks = np.linspace(0, ys.size - 1, min(PROBE_POINTS, ys.size)).astype(int)
+    return [(int(ys[i]), int(xs[i]), int(template[ys[i], xs[i]])) for i in picks]
+
 
-    if not os.path.exists(screen_path):
-        print(f"Screenshot file not found: {screen_path}")
+@dataclass
+class Template:
+    """
+    A UI element to look for, loaded once along with everything derived from it that matching needs.
+    """
+    name: str
+    gray: np.ndarray
+    h: int
+    w: int
+    # Downscaled by PYRAMID_SCALE for the coarse pass.
+    small: np.ndarray
+    # Region of the screen where the element always appears, see _roi_bounds.
+    roi: Optional[Tuple] = None
+    threshold: float = 0.8
+    # Pixels checked by quick_probe, for elements that are always at the same column but rarely on the screen.
+    # The column is learned from the latest match.
+    probe_pts: List[Tuple[int, int, int]] = field(default_factory=list)
+    probe_column: Optional[int] = None
+    # DFT of the zero-mean downscaled template and its norm, by DFT size.
+    # There are only a few sizes, see DFT_HEIGHT_STEP.
+    fft: Dict[Tuple[int, int], Tuple[np.ndarray, float]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path, roi=None, threshold=0.8, probe=False):
+        """
+        Loads a template image. probe enables quick_probe for it.
+        """
+        # The UI elements are recognizable without color, and matching a single channel is much cheaper.
+        gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise FileNotFoundError(f"Error loading template: {path}")
+
+        h, w = gray.shape[:2]
+        return cls(name=path, gray=gray, h=h, w=w, small=_downscale(gray), roi=roi, threshold=threshold,
+                   probe_pts=_probe_points(gray) if probe else [])
+
+    def spectrum(self, shape):
+        """
+        Returns the DFT of the zero-mean downscaled template padded to shape, along with the template's norm.
+        """
+        if shape not in self.fft:
+            centered = self.small.astype(np.float32) - self.small.mean()
+            self.fft[shape] = _spectrum(centered, shape), float(np.sqrt(np.sum(centered.astype(np.float64) ** 2)))
+        return self.fft[shape]
+
+
+# Regions of the screen, as (x0, y0, x1, y1), where some UI elements always appear.
+# These follow slice semantics: None means the edge of the screen, and negative values count from the right/bottom.
+ROI_BACK = (0, 0, 300, 300)
+ROI_LOADMORE = (0, -400, None, None)
+ROI_DOWNLOAD = (-250, 0, None, None)
+
+# Options for each template, by name. The image is loaded from <name>.png in the current directory.
+_TEMPLATE_OPTIONS = {
+    "add_your_comment": dict(probe=True),
+    "back": dict(roi=ROI_BACK),
+    "closepic": dict(),
+    "closevideo": dict(),
+    "download": dict(roi=ROI_DOWNLOAD),
+    "download_video": dict(),
+    "downloadingvideo": dict(),
+    "failed_to_download": dict(),
+    "loadmore": dict(roi=ROI_LOADMORE),
+    "ok_after_failed": dict(),
+    "right": dict(),
+    "video_ok": dict(),
+}
+TEMPLATE_FILES = [f"{name}.png" for name in _TEMPLATE_OPTIONS]
+
+# Check for all the templates up front, so lookups never have to.
+_missing = [f for f in TEMPLATE_FILES if not os.path.exists(f)]
+if _missing:
+    raise FileNotFoundError(f"Template files not found: {', '.join(_missing)}. "
+                            "Run the script from the directory that contains them.")
+
+TEMPLATES = {name: Template.load(f"{name}.png", **options) for name, options in _TEMPLATE_OPTIONS.items()}
+
+
+def _roi_bounds(screen, roi):
+    """
+    Resolves roi against the size of the screen.
+    Returns (x0, y0, x1, y1) in pixels.
+    """
+    if roi is None:
+        return 0, 0, screen.shape[1], screen.shape[0]
+
+    x0, y0, x1, y1 = roi
+    x0, x1, _ = slice(x0, x1).indices(screen.shape[1])
+    y0, y1, _ = slice(y0, y1).indices(screen.shape[0])
+    return x0, y0, x1, y1
+
+
+def _crop(screen, roi):
+    """
+    Returns the part of the screen inside roi, along with the (x, y) offset of that part.
+    """
+    x0, y0, x1, y1 = _roi_bounds(screen, roi)
+    return screen[y0:y1, x0:x1], (x0, y0)
+
+
+# Values derived from the screenshot being searched, such as its downscaled copy and DFT.
+# They are shared by all the templates looked for in the same screenshot, even from different threads.
+_frame_lock = threading.Lock()
+_frame_base = None
+_frame_values = {}
+
+
+def _frame_value(screen, name, compute):
+    """
+    Returns compute(), computing it only once per region of a screenshot.
+    The lock is not held while computing, so that other lookups don't wait for it. Two threads may then
+    compute the same value, but only the first result is kept.
+    """
+    global _frame_base, _frame_values
+    base = screen if screen.base is None else screen.base
+    # The data pointer and shape identify the region; holding on to the base keeps the pointer from being reused.
+    key = (name, screen.__array_interface__["data"][0], screen.shape)
+    with _frame_lock:
+        if _frame_base is not base:
+            _frame_base, _frame_values = base, {}
+        values = _frame_values
+        if key in values:
+            return values[key]
+
+    value = compute()
+    with _frame_lock:
+        return values.setdefault(key, value)
+
+
+def _match_fft(screen, tmpl):
+    """
+    Same as cv2.matchTemplate(downscaled screen, tmpl.small, cv2.TM_CCOEFF_NORMED),
+    but correlates through the DFT. The spectra of the screen and the template are each computed once
+    and reused for every match against them.
+    The correlation is normalized with window sums taken from integral images, like OpenCV does.
+    """
+    image = _frame_value(screen, "downscaled", lambda: _downscale(screen))
+    h, w = tmpl.small.shape[:2]
+    H, W = image.shape[:2]
+    shape = (cv2.getOptimalDFTSize(-(-H // DFT_HEIGHT_STEP) * DFT_HEIGHT_STEP), cv2.getOptimalDFTSize(W))
+    screen_spectrum = _frame_value(screen, ("spectrum", shape), lambda: _spectrum(image, shape))
+    template_spectrum, template_norm = tmpl.spectrum(shape)
+
+    # The padding is at least as large as the template, so the valid part of the circular correlation is exact.
+    corr = cv2.idft(cv2.mulSpectrums(screen_spectrum, template_spectrum, 0, conjB=True),
+                    flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)[:H - h + 1, :W - w + 1]
+
+    sums, sq_sums = _frame_value(screen, "integral",
+                                 lambda: cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F))
+    window_sum = sums[h:, w:] - sums[:-h, w:] - sums[h:, :-w] + sums[:-h, :-w]
+    window_sq_sum = sq_sums[h:, w:] - sq_sums[:-h, w:] - sq_sums[h:, :-w] + sq_sums[:-h, :-w]
+    window_norm = np.sqrt(np.maximum(window_sq_sum - window_sum * window_sum / (h * w), 0)).astype(np.float32)
+
+    # Flat windows have no meaningful correlation.
+    denominator = window_norm * template_norm
+    return np.divide(corr, denominator, out=np.zeros_like(corr), where=window_norm > 1e-3)
+
+
+def _candidate_regions(screen, tmpl, threshold):
+    """
+    Matches the downscaled template against the downscaled screen, merging neighbouring hits.
+    Returns a list of (x0, y0, x1, y1) full resolution regions that may contain a match, from top to bottom.
+    """
+    if tmpl.small.size >= FFT_MIN_AREA:
+        res = _match_fft(screen, tmpl)
+    else:
+        res = cv2.matchTemplate(_frame_value(screen, "downscaled", lambda: _downscale(screen)), tmpl.small,
+                                cv2.TM_CCOEFF_NORMED)
+    mask = (res >= threshold - COARSE_MARGIN).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+
+    # Pad every block of candidates by half the template size on every side.
+    h, w = tmpl.h, tmpl.w
+    regions = []
+    for (x, y, bw, bh, _) in stats[1:]:
+        x0 = max(0, x * PYRAMID_SCALE - w // 2)
+        y0 = max(0, y * PYRAMID_SCALE - h // 2)
+        x1 = min(screen.shape[1], (x + bw - 1) * PYRAMID_SCALE + w + w // 2)
+        y1 = min(screen.shape[0], (y + bh - 1) * PYRAMID_SCALE + h + h // 2)
+        regions.append((int(x0), int(y0), int(x1), int(y1)))
+    return sorted(regions, key=lambda r: (r[1], r[0]))
+
+
+@njit(cache=True)
+def _suppress_sorted(order, xs, ys, cells_x, cells_y, grid, w, h):
+    """
+    The loop of _suppress, compiled with numba when it's installed.
+    Returns the kept indices in a prefix of order, and how many there are.
+    """
+    n = 0
+    for i in order:
+        cx, cy = cells_x[i], cells_y[i]
+        overlaps = False
+        for gy in range(cy - 1, cy + 2):
+            for gx in range(cx - 1, cx + 2):
+                j = grid[gy, gx]
+                if j >= 0 and abs(xs[j] - xs[i]) < w and abs(ys[j] - ys[i]) < h:
+                    overlaps = True
+        if not overlaps:
+            grid[cy, cx] = i
+            order[n] = i
+            n += 1
+    return order, n
+
+
+def _suppress(xs, ys, scores, w, h):
+    """
+    Non-maximum suppression: goes through the matches from best to worst, dropping the ones that overlap
+    a match that was already kept.
+    Kept matches never overlap, so a grid of (w x h) cells holds at most one of them per cell
+    and only the neighbouring cells have to be checked.
+    Returns the indices of the kept matches, from top to bottom.
+    """
+    xs, ys = xs.astype(np.int64), ys.astype(np.int64)
+    order = np.argsort(-scores, kind="stable")
+    cells_x = xs // w + 1
+    cells_y = ys // h + 1
+    grid = np.full((cells_y.max() + 2, cells_x.max() + 2), -1, dtype=np.int64)
+
+    keep, n = _suppress_sorted(order, xs, ys, cells_x, cells_y, grid, w, h)
+    return sorted(keep[:n].tolist(), key=lambda i: (ys[i], xs[i]))
+
+
+def quick_probe(screen, tmpl, left):
+    """
+    Cheaply checks whether the template could be on the screen with its left edge at column left,
+    by comparing a few of its pixels with the screen at every height.
+    May let through screens without a match, and rules out matches at any other column.
+    """
+    h, w = tmpl.h, tmpl.w
+    if left < 0 or left + w > screen.shape[1]:
+        return True
+
+    possible = np.ones(screen.shape[0] - h + 1, dtype=bool)
+    for dy, dx, value in tmpl.probe_pts:
+        column = screen[dy:dy + possible.size, left + dx].astype(np.int16)
+        possible &= np.abs(column - value) <= PROBE_TOLERANCE
+        if not possible.any():
+            return False
+    return True
+
+
+def find_element(tmpl, screen=None, roi=None, threshold=None, first=False, probe=True):
+    """
+    Locates a UI element (template) within the screenshot (the most recent one by default).
+    Only the template's region of the screen is searched, unless another roi is given.
+    If first is set, returns the topmost match rather than the best one, without looking any further down.
+    If probe is not set, quick_probe is skipped even if the template has been seen before.
+    Returns the (x, y) coordinates of the center of the match, or None if not found.
+    """
+    if screen is None:
+        screen = _last_screen
+    if screen is None:
+        print("No screenshot available.")
         return None
 
-    # Load images
-    img_rgb = cv2.imread(screen_path)
-    template = cv2.imread(template_path)
+    if roi is None:
+        roi = tmpl.roi
+    if threshold is None:
+        threshold = tmpl.threshold
+    h, w = tmpl.h, tmpl.w
 
-    if img_rgb is None or template is None:
-        print("Error loading images.")
+    screen, (off_x, off_y) = _crop(screen, roi)
+    if screen.shape[0] < h or screen.shape[1] < w:
+        print(f"Region {roi} is smaller than '{tmpl.name}'.")
         return None
 
-    h, w = template.shape[:2]
+    # Once a probed element has been seen, rule out most screens without it before matching.
+    if probe and tmpl.probe_column is not None and not quick_probe(screen, tmpl, tmpl.probe_column - off_x):
+        print(f"Element '{tmpl.name}' not found by quick probe.")
+        return None
 
-    # Perform template matching
-    res = cv2.matchTemplate(img_rgb, template, cv2.TM_CCOEFF_NORMED)
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+    # Refine every candidate at full resolution and keep the best one.
+    max_val, max_loc = 0, None
+    for (x0, y0, x1, y1) in _candidate_regions(screen, tmpl, threshold):
+        res = cv2.matchTemplate(screen[y0:y1, x0:x1], tmpl.gray, cv2.TM_CCOEFF_NORMED)
+        _, val, _, loc = cv2.minMaxLoc(res)
+        if val > max_val:
+            max_val, max_loc = val, (x0 + loc[0], y0 + loc[1])
+        if first and max_val >= threshold:
+            break
 
     if max_val >= threshold:
         # max_loc is the top-left corner of the match
-        center_x = max_loc[0] + w // 2
-        center_y = max_loc[1] + h // 2
-        # print(f"Found element '{template_path}' at ({center_x}, {center_y}) with confidence {max_val:.2f}")
+        center_x = off_x + max_loc[0] + w // 2
+        center_y = off_y + max_loc[1] + h // 2
+        # print(f"Found element '{tmpl.name}' at ({center_x}, {center_y}) with confidence {max_val:.2f}")
+        if tmpl.probe_pts:
+            tmpl.probe_column = off_x + max_loc[0]
         return (center_x, center_y)
     else:
-        print(f"Element '{template_path}' not found. Max confidence: {max_val:.2f}")
+        print(f"Element '{tmpl.name}' not found. Max confidence: {max_val:.2f}")
         return None
 
 
-def find_all_elements(template_path, screen_path="screen.png", threshold=0.8):
+def find_all_elements(tmpl, screen=None, roi=None, threshold=None):
     """
-    Locates all occurrences of a UI element (template) within the screenshot.
+    Locates all occurrences of a UI element (template) within the screenshot (the most recent one by default).
+    Only the template's region of the screen is searched, unless another roi is given.
     Returns a list of (x, y) coordinates of the centers of the matches.
     """
-    if not os.path.exists(template_path):
-        print(f"Template file not found: {template_path}")
+    if screen is None:
+        screen = _last_screen
+    if screen is None:
+        print("No screenshot available.")
         return []
 
-    if not os.path.exists(screen_path):
-        print(f"Screenshot file not found: {screen_path}")
+    if roi is None:
+        roi = tmpl.roi
+    if threshold is None:
+        threshold = tmpl.threshold
+    h, w = tmpl.h, tmpl.w
+
+    screen, (off_x, off_y) = _crop(screen, roi)
+    if screen.shape[0] < h or screen.shape[1] < w:
+        print(f"Region {roi} is smaller than '{tmpl.name}'.")
         return []
 
-    # Load images
-    img_rgb = cv2.imread(screen_path)
-    template = cv2.imread(template_path)
+    # Find all matches above threshold, only looking at the candidate regions at full resolution.
+    xs, ys, scores = [], [], []
+    for (x0, y0, x1, y1) in _candidate_regions(screen, tmpl, threshold):
+        res = cv2.matchTemplate(screen[y0:y1, x0:x1], tmpl.gray, cv2.TM_CCOEFF_NORMED)
 
-    if img_rgb is None or template is None:
-        print("Error loading images.")
+        # loc is a tuple of arrays (y_coords, x_coords)
+        loc = np.where(res >= threshold)
+        xs.append(loc[1] + off_x + x0)
+        ys.append(loc[0] + off_y + y0)
+        scores.append(res[loc])
+
+    if not sum(len(x) for x in xs):
+        print(f"Element '{tmpl.name}' not found.")
         return []
 
-    h, w = template.shape[:2]
+    xs, ys, scores = np.concatenate(xs), np.concatenate(ys), np.concatenate(scores)
+    found_points = []
+    for i in _suppress(xs, ys, scores, w, h):
+        center_x = int(xs[i]) + w // 2
+        center_y = int(ys[i]) + h // 2
+        found_points.append((center_x, center_y))
+        # print(f"Found element '{tmpl.name}' at ({center_x}, {center_y})")
+
+    return found_points
 
-    # Perform template matching
-    res = cv2.matchTemplate(img_rgb, template, cv2.TM_CCOEFF_NORMED)
 
-    # Find all matches above threshold
-    loc = np.where(res >= threshold)
+# Pixels whose gray level changed by more than this between two screenshots count as changed.
+DIFF_THRESHOLD = 5
+# If more than this fraction of the rows changed, just search the whole screen again.
+MAX_DIFF_FRACTION = 0.5
 
-    # loc is a tuple of arrays (y_coords, x_coords)
-    # Zip them into (x, y) points
-    points = list(zip(*loc[::-1]))
 
-    if not points:
-        print(f"Element '{template_path}' not found.")
-        return []
+def changed_rows(prev, screen):
+    """
+    Compares two screenshots.
+    Returns the (y0, y1) band of rows that changed, or None if nothing changed.
+    """
+    if prev is None or prev.shape != screen.shape:
+        return 0, screen.shape[0]
 
-    # Non-maximum suppression (simple distance-based)
-    found_points = []
+    rows = np.flatnonzero(np.any(cv2.absdiff(prev, screen) > DIFF_THRESHOLD, axis=1))
+    if rows.size == 0:
+        return None
+    return int(rows[0]), int(rows[-1]) + 1
 
-    # Let's convert points to rectangles [x, y, w, h] for groupRectangles
-    rects = []
-    for pt in points:
-        rects.append([int(pt[0]), int(pt[1]), int(w), int(h)])
 
-    rects, weights = cv2.groupRectangles(rects, 1, 0.2)
+def _overlaps_band(center_y, h, band):
+    top = center_y - h // 2
+    return top < band[1] and top + h > band[0]
 
-    for (x, y, w, h) in rects:
-        center_x = x + w // 2
-        center_y = y + h // 2
-        found_points.append((center_x, center_y))
-        # print(f"Found element '{template_path}' at ({center_x}, {center_y})")
 
-    return found_points
+class IncrementalMatcher:
+    """
+    Repeats template lookups on successive screenshots, only searching the rows that changed since
+    the previous screenshot. Matches that lie entirely in unchanged rows are carried over.
+    """
+
+    def __init__(self):
+        self.prev_screen = None
+        self.band = (0, 0)
+        # Results of the lookups on the previous screenshot, and on the current one.
+        self.prev = {}
+        self.current = {}
+
+    def update(self, screen):
+        """
+        Moves on to a new screenshot.
+        """
+        self.band = changed_rows(self.prev_screen, screen)
+        if self.band is not None and self.band[1] - self.band[0] > MAX_DIFF_FRACTION * screen.shape[0]:
+            self.band = (0, screen.shape[0])
+        self.prev_screen = screen
+        # Only results for the previous screenshot can be carried over.
+        self.prev, self.current = self.current, {}
+
+    def _band_roi(self, screen, roi, h):
+        """
+        Narrows roi down to the rows where a match would overlap the changed band.
+        Returns None if no match inside roi can overlap it.
+        """
+        x0, y0, x1, y1 = _roi_bounds(screen, roi)
+        y0 = max(y0, self.band[0] - h)
+        y1 = min(y1, self.band[1] + h)
+        if y1 - y0 < h:
+            return None
+        return x0, y0, x1, y1
+
+    def _is_fresh(self, key, screen):
+        return key not in self.prev or self.band == (0, screen.shape[0])
+
+    def find_element(self, tmpl, screen, roi=None, first=False):
+        """
+        Same as find_element, for the screenshot passed to the last call to update.
+        """
+        if roi is None:
+            roi = tmpl.roi
+        key = (tmpl.name, roi, first)
+        if self._is_fresh(key, screen):
+            coord = find_element(tmpl, screen, roi, first=first)
+        elif self.band is None:
+            coord = self.prev[key]
+        else:
+            h = tmpl.h
+            coord = self.prev[key]
+            if coord is None:
+                # Nothing matched in the unchanged rows before, so only the changed rows need to be searched.
+                band_roi = self._band_roi(screen, roi, h)
+                coord = find_element(tmpl, screen, band_roi, first=first) if band_roi else None
+            elif _overlaps_band(coord[1], h, self.band) or (first and self.band[0] < coord[1]):
+                # The previous match changed, or a new one may have shown up above it.
+                # There may be others in the unchanged rows, so search everything.
+                coord = find_element(tmpl, screen, roi, first=first)
+
+        self.current[key] = coord
+        return coord
+
+    def find_all_elements(self, tmpl, screen, roi=None):
+        """
+        Same as find_all_elements, for the screenshot passed to the last call to update.
+        """
+        if roi is None:
+            roi = tmpl.roi
+        key = (tmpl.name, roi)
+        if self._is_fresh(key, screen):
+            coords = find_all_elements(tmpl, screen, roi)
+        elif self.band is None:
+            coords = self.prev[key]
+        else:
+            h = tmpl.h
+            coords = [c for c in self.prev[key] if not _overlaps_band(c[1], h, self.band)]
+            band_roi = self._band_roi(screen, roi, h)
+            if band_roi:
+                coords += [c for c in find_all_elements(tmpl, screen, band_roi)
+                           if _overlaps_band(c[1], h, self.band)]
+            coords.sort(key=lambda c: (c[1], c[0]))
+
+        self.current[key] = coords
+        return coords
+
+
+class AdbShell:
+    """
+    A long-lived "adb shell" session that commands are streamed into.
+    This avoids paying for a new adb connection and shell for every tap or swipe.
+    """
+    SENTINEL = "__D__"
+    # Prints the sentinel and the exit status. The quotes keep the sentinel itself out of the command,
+    # in case the shell echoes its input back.
+    SENTINEL_ECHO = 'echo __D""__ $?'
+
+    def __enter__(self):
+        self.p = subprocess.Popen(["adb", "shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.p.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.p.wait()
+
+    def run(self, cmd):
+        """
+        Runs a command in the shell and waits for it to finish.
+        Returns the output of the command, or raises CalledProcessError if it failed.
+        """
+        try:
+            self.p.stdin.write(f"{cmd}; {self.SENTINEL_ECHO}\n".encode())
+        except BrokenPipeError:
+            raise subprocess.CalledProcessError(self.p.poll(), cmd)
+
+        output = []
+        while True:
+            line = self.p.stdout.readline()
+            if not line:
+                # The shell went away.
+                raise subprocess.CalledProcessError(self.p.poll(), cmd, "\n".join(output))
+
+            line = line.decode(errors="replace").rstrip("\r\n")
+            before, sentinel, status = line.partition(self.SENTINEL)
+            if before:
+                output.append(before)
+            if sentinel:
+                break
+
+        try:
+            status = int(status)
+        except ValueError:
+            raise subprocess.CalledProcessError(-1, cmd, "\n".join(output))
+        if status != 0:
+            raise subprocess.CalledProcessError(status, cmd, "\n".join(output))
+        return "\n".join(output)
 
 
 def tap_element(x, y):
@@ -124,12 +743,29 @@ def tap_element(x, y):
     Simulates a tap at the given coordinates using ADB.
     """
     try:
-        subprocess.check_call(["adb", "shell", "input", "tap", str(x), str(y)])
+        adb_shell.run(f"input tap {x} {y}")
         # print(f"Tapped at ({x}, {y})")
         return True
     except subprocess.CalledProcessError as e:
         print(f"Error tapping element: {e}")
         return False
+    finally:
+        _screen_pipeline.invalidate()
+
+
+def tap_all(coords, delay=1):
+    """
+    Taps each of the given coordinates in turn, waiting delay seconds after every tap.
+    The whole sequence runs on the device as a single shell command.
+    """
+    try:
+        adb_shell.run("; ".join(f"input tap {x} {y}; sleep {delay}" for x, y in coords))
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error tapping elements: {e}")
+        return False
+    finally:
+        _screen_pipeline.invalidate()
 
 
 def scroll(start_x, start_y, end_x, end_y, duration=300):
@@ -137,12 +773,13 @@ def scroll(start_x, start_y, end_x, end_y, duration=300):
     Swipes from (start_x, start_y) to (end_x, end_y).
     """
     try:
-        subprocess.check_call(["adb", "shell", "input", "swipe", str(start_x), str(start_y), str(end_x), str(end_y),
-                               str(duration)])
+        adb_shell.run(f"input swipe {start_x} {start_y} {end_x} {end_y} {duration}")
         # print(f"Scrolled from ({start_x}, {start_y}) to ({end_x}, {end_y})")
         return True
     except subprocess.CalledProcessError:
         return False
+    finally:
+        _screen_pipeline.invalidate()
 
 
 def scroll_down_one_entry(current_rightarrow_location):
@@ -174,47 +811,69 @@ def scroll_down_one_video(current_download_location):
     return scroll(cur_x, cur_y, cur_x, new_y, 1000)
 
 
+def entry_loaded(screen, download, close):
+    """
+    Checks whether an entry is open and shows something the entry loops act on: a download button
+    (the download template), the end of the entry, or an open picture or video (the close template).
+    The back button shows up before the pictures have loaded, so it isn't enough on its own.
+    """
+    if find_element(TEMPLATES["back"], screen) is None:
+        return False
+    return any(find_element(TEMPLATES[name], screen, first=True) is not None
+               for name in (download, "add_your_comment", close))
+
+
 def download_all_photos_from_entry():
+    # Only the parts of the screen that changed between iterations need to be searched again.
+    matcher = IncrementalMatcher()
     # Don't loop forever if all detection fails.
     for _ in range(100):
-        if not take_screenshot():
+        screen = take_screenshot()
+        if screen is None:
             print("Failed to take screenshot.")
             break
 
+        # The lookups below are independent, so run them all at once.
+        matcher.update(screen)
+        close_future = _executor.submit(matcher.find_element, TEMPLATES["closepic"], screen)
+        end_future = _executor.submit(matcher.find_element, TEMPLATES["add_your_comment"], screen)
+        # Only the topmost download button is needed unless this is the end of the entry.
+        download_future = _executor.submit(matcher.find_element, TEMPLATES["download"], screen, first=True)
+        close, end, download = close_future.result(), end_future.result(), download_future.result()
+
         # Figure out if a picture is open by mistake.
-        coord = find_element("closepic.png")
-        if coord is not None:
+        if close is not None:
             # Picture is open. Close it.
             print("Closing open photo")
-            tap_element(*coord)
-            time.sleep(1)
+            tap_element(*close)
+            wait_until(lambda screen: find_element(TEMPLATES["closepic"], screen) is None)
             continue
 
         # Figure out if we're at the end of the entry.
         # There is an "Add your comment" button at the end of every entry.
-        coord = find_element("add_your_comment.png")
-        if coord is not None:
+        # quick_probe only checks the column where it was seen before. In case it moved, look everywhere
+        # before scrolling past it without looking.
+        if end is None and download is None:
+            end = find_element(TEMPLATES["add_your_comment"], screen, probe=False)
+        if end is not None:
             # Reached the end.
-            coords = find_all_elements("download.png")
-            for c in coords:
-                if not args.dry_run:
-                    # print(f"tapping {c}")
+            coords = find_all_elements(TEMPLATES["download"], screen)
+            if not args.dry_run and coords:
+                for c in coords:
                     print(f"Downloading image at {c}")
-                    tap_element(*c)
-                    time.sleep(1)
+                # Nothing needs to be checked between these taps, so send them to the device in one go.
+                tap_all(coords)
             # Exit the outer loop
             break
 
         # Otherwise, find the download buttons, download the first picture, and scroll the list
         # until the download button is no longer visible.
-        coords = find_all_elements("download.png")
-        if len(coords) > 0:
-            # print(f"Found {len(coords)} elements at {coords}")
+        if download is not None:
             if not args.dry_run:
-                print(f"Downloading image at {coords[0]}")
-                tap_element(*coords[0])
+                print(f"Downloading image at {download}")
+                tap_element(*download)
                 time.sleep(1)
-            scroll_down_one_picture(coords[0])
+            scroll_down_one_picture(download)
         else:
             # If there are no visible download buttons, scroll the view until the bottom
             # of the current entry is no longer visible.
@@ -223,25 +882,34 @@ def download_all_photos_from_entry():
     # After downloading all photos from an entry, go back to the main screen.
     # Sometimes the overlay that shows where pictures are downloaded will block the back button, so try a few times.
     for _ in range(5):
-        if not take_screenshot():
+        screen = take_screenshot()
+        if screen is None:
             break
         time.sleep(1)
-        coord = find_element("back.png")
+        coord = find_element(TEMPLATES["back"], screen)
         if coord is not None:
             tap_element(*coord)
-            time.sleep(2)
+            # Wait for the list of entries to show up again.
+            wait_until(lambda screen: find_element(TEMPLATES["right"], screen, first=True) is not None
+                       or find_element(TEMPLATES["loadmore"], screen) is not None, timeout=5)
             break
 
 
 def wait_for_video_download():
     downloading = False
 
-    # Wait roughly 50 seconds for a video to download.
-    for _ in range(50):
-        if not take_screenshot():
+    # Wait up to 50 seconds for a video to download.
+    # Screenshots are quick now, so this has to be a time limit rather than a number of screenshots.
+    deadline = time.monotonic() + 50
+    while time.monotonic() < deadline:
+        # Nothing is done on the device between these screenshots, so start on the next one early.
+        screen = take_screenshot(prefetch=True)
+        if screen is None:
+            # Don't keep hammering adb while it's failing.
+            time.sleep(1)
             continue
 
-        coord = find_element("downloadingvideo.png")
+        coord = find_element(TEMPLATES["downloadingvideo"], screen)
         if not downloading:
             downloading = coord is not None
             if downloading:
@@ -252,10 +920,10 @@ def wait_for_video_download():
             if coord:
                 continue
 
-            if find_element("failed_to_download.png") is not None:
+            if find_element(TEMPLATES["failed_to_download"], screen) is not None:
                 print("failed to download")
                 for i in range(5):
-                    coord = find_element("ok_after_failed.png")
+                    coord = find_element(TEMPLATES["ok_after_failed"], screen)
                     if not coord:
                         continue
                     print("clicking ok")
@@ -266,12 +934,18 @@ def wait_for_video_download():
             print("Download complete")
             break
 
-    for _ in range(5):
-        if not take_screenshot():
+    # Give the "video downloaded" popup up to 5 seconds to show up.
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        # Nothing is done on the device between these screenshots, so start on the next one early.
+        screen = take_screenshot(prefetch=True)
+        if screen is None:
+            # Don't keep hammering adb while it's failing.
+            time.sleep(1)
             continue
 
         # Close the "video downloaded" popup.
-        coord = find_element("video_ok.png")
+        coord = find_element(TEMPLATES["video_ok"], screen)
         if not coord:
             continue
 
@@ -279,29 +953,45 @@ def wait_for_video_download():
         time.sleep(1)
         break
 
+    # Don't leave a prefetched screenshot behind for the next lookup.
+    _screen_pipeline.invalidate()
+
 
 def download_all_videos_from_entry():
+    # Only the parts of the screen that changed between iterations need to be searched again.
+    matcher = IncrementalMatcher()
     # Don't loop forever if all detection fails.
     for _ in range(100):
-        if not take_screenshot():
+        screen = take_screenshot()
+        if screen is None:
             print("Failed to take screenshot.")
             break
 
+        # The lookups below are independent, so run them all at once.
+        matcher.update(screen)
+        close_future = _executor.submit(matcher.find_element, TEMPLATES["closevideo"], screen)
+        end_future = _executor.submit(matcher.find_element, TEMPLATES["add_your_comment"], screen)
+        # Only the topmost download button is needed unless this is the end of the entry.
+        download_future = _executor.submit(matcher.find_element, TEMPLATES["download_video"], screen, first=True)
+        close, end, download = close_future.result(), end_future.result(), download_future.result()
+
         # Figure out if a video is open by mistake.
-        coord = find_element("closevideo.png")
-        if coord is not None:
+        if close is not None:
             # Video is open. Close it.
             print("Closing open video")
-            tap_element(*coord)
-            time.sleep(1)
+            tap_element(*close)
+            wait_until(lambda screen: find_element(TEMPLATES["closevideo"], screen) is None)
             continue
 
         # Figure out if we're at the end of the entry.
         # There is an "Add your comment" button at the end of every entry.
-        coord = find_element("add_your_comment.png")
-        if coord is not None:
+        # quick_probe only checks the column where it was seen before. In case it moved, look everywhere
+        # before scrolling past it without looking.
+        if end is None and download is None:
+            end = find_element(TEMPLATES["add_your_comment"], screen, probe=False)
+        if end is not None:
             # Reached the end.
-            coords = find_all_elements("download_video.png")
+            coords = find_all_elements(TEMPLATES["download_video"], screen)
             for c in coords:
                 print(f"Downloading video at {c}")
                 if not args.dry_run:
@@ -314,14 +1004,12 @@ def download_all_videos_from_entry():
 
         # Otherwise, find the download buttons, download the first video, and scroll the list
         # until the download button is no longer visible.
-        coords = find_all_elements("download_video.png")
-        if len(coords) > 0:
-            # print(f"Found {len(coords)} elements at {coords}")
+        if download is not None:
             if not args.dry_run:
-                print(f"Downloading image at {coords[0]}")
-                tap_element(*coords[0])
+                print(f"Downloading image at {download}")
+                tap_element(*download)
                 time.sleep(1)
-            scroll_down_one_video(coords[0])
+            scroll_down_one_video(download)
         else:
             # If there are no visible download buttons, scroll the view until the bottom
             # of the current entry is no longer visible.
@@ -330,13 +1018,16 @@ def download_all_videos_from_entry():
     # After downloading all photos from an entry, go back to the main screen.
     # Sometimes the overlay that shows where pictures are downloaded will block the back button, so try a few times.
     for _ in range(5):
-        if not take_screenshot():
+        screen = take_screenshot()
+        if screen is None:
             break
         time.sleep(1)
-        coord = find_element("back.png")
+        coord = find_element(TEMPLATES["back"], screen)
         if coord is not None:
             tap_element(*coord)
-            time.sleep(2)
+            # Wait for the list of entries to show up again.
+            wait_until(lambda screen: find_element(TEMPLATES["right"], screen, first=True) is not None
+                       or find_element(TEMPLATES["loadmore"], screen) is not None, timeout=5)
             break
 
 
@@ -349,51 +1040,60 @@ if __name__ == "__main__":
     if args.dry_run:
         print("Dry run mode enabled. No actions will be taken.")
 
-    if args.videos:
-        # If everything else fails, at least don't loop forever.
-        for _ in range(10000):
-            if not take_screenshot():
-                break
-
-            # Have we reached the end?
-            if find_element("loadmore.png") is not None:
-                break
-
-            # Tap one video entry.
-            if not take_screenshot():
-                break
+    check_opencv_build()
 
-            coords = find_all_elements("right.png")
-            if len(coords) == 0:
-                print("No right arrows found.")
-                break
+    with AdbShell() as adb_shell:
+        if args.videos:
+            # If everything else fails, at least don't loop forever.
+            for _ in range(10000):
+                screen = take_screenshot()
+                if screen is None:
+                    break
 
-            # print(f"Found {len(coords)} elements at {coords}")
-            tap_element(*coords[0])
-            time.sleep(2)
-            # Download all photos for one entry.
-            download_all_videos_from_entry()
-            scroll_down_one_entry(coords[0])
+                loadmore_future = _executor.submit(find_element, TEMPLATES["loadmore"], screen)
+                right_future = _executor.submit(find_all_elements, TEMPLATES["right"], screen)
+                loadmore, coords = loadmore_future.result(), right_future.result()
 
-        sys.exit(0)
+                # Have we reached the end?
+                if loadmore is not None:
+                    break
 
-    # If everything else fails, at least don't loop forever.
-    for _ in range(10000):
-        # Have we reached the end?
-        if take_screenshot():
-            if find_element("loadmore.png") is not None:
-                break
+                # Tap one video entry.
+                if len(coords) == 0:
+                    print("No right arrows found.")
+                    break
 
-        # Tap one photo entry.
-        if take_screenshot():
-            coords = find_all_elements("right.png")
-            if len(coords) > 0:
                 # print(f"Found {len(coords)} elements at {coords}")
                 tap_element(*coords[0])
-                time.sleep(2)
+                # Wait for the entry to open and its videos to load.
+                wait_until(lambda screen: entry_loaded(screen, "download_video", "closevideo"), timeout=5)
                 # Download all photos for one entry.
-                download_all_photos_from_entry()
+                download_all_videos_from_entry()
                 scroll_down_one_entry(coords[0])
-            else:
-                print("No right arrows found.")
-                break
+
+            sys.exit(0)
+
+        # If everything else fails, at least don't loop forever.
+        for _ in range(10000):
+            screen = take_screenshot()
+            if screen is not None:
+                loadmore_future = _executor.submit(find_element, TEMPLATES["loadmore"], screen)
+                right_future = _executor.submit(find_all_elements, TEMPLATES["right"], screen)
+                loadmore, coords = loadmore_future.result(), right_future.result()
+
+                # Have we reached the end?
+                if loadmore is not None:
+                    break
+
+                # Tap one photo entry.
+                if len(coords) > 0:
+                    # print(f"Found {len(coords)} elements at {coords}")
+                    tap_element(*coords[0])
+                    # Wait for the entry to open and its pictures to load.
+                    wait_until(lambda screen: entry_loaded(screen, "download", "closepic"), timeout=5)
+                    # Download all photos for one entry.
+                    download_all_photos_from_entry()
+                    scroll_down_one_entry(coords[0])
+                else:
+                    print("No right arrows found.")
+                    break